@@ -5,80 +5,319 @@ import subprocess
 import logging
 import argparse
 from dotenv import load_dotenv
-import shlex
-import re
 import socket
+import errno
 import platform
+import json
+import itertools
+import tempfile
+import re
+import urllib.error
+import urllib.request
+import functools
+import io
+from concurrent.futures import ThreadPoolExecutor
 import yaml
-from typing import Dict, List
+from typing import Dict, List, Optional
+
+try:
+    import yaml_rs  # Optional Rust-backed parser, much faster than PyYAML
+except ImportError:
+    yaml_rs = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Generated Dockerfile
+DOCKERFILE_PATH = 'PostgresWithExtensions.dockerfile'
+
+# Latest GitHub release assets, revalidated with ETags so unchanged releases cost no rate limit
+RELEASE_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.cache', 'pg-extensions', 'releases.json')
+
+# BuildKit cache mounts so apt downloads and package lists survive between builds
+# without ever being part of a layer
+APT_CACHE_MOUNTS = (
+    '--mount=type=cache,target=/var/cache/apt,sharing=locked',
+    '--mount=type=cache,target=/var/lib/apt/lists,sharing=locked',
+)
+# The base image's apt hook deletes downloaded packages, which would empty the cache mounts.
+# The builder stage drops it; the runtime stage only sets it aside so the shipped image keeps it
+DROP_DOCKER_CLEAN = "rm -f /etc/apt/apt.conf.d/docker-clean"
+SET_ASIDE_DOCKER_CLEAN = ("if [ -f /etc/apt/apt.conf.d/docker-clean ]; "
+                          "then mv /etc/apt/apt.conf.d/docker-clean /tmp/docker-clean; fi")
+RESTORE_DOCKER_CLEAN = ("if [ -f /tmp/docker-clean ]; "
+                        "then mv /tmp/docker-clean /etc/apt/apt.conf.d/docker-clean; fi")
+
+# x.y.z release tags in `git ls-remote --tags` output
+RELEASE_TAG_RE = re.compile(r'refs/tags/(\d+\.\d+\.\d+)$', re.MULTILINE)
+
+# PostgreSQL major version in an install path such as /usr/lib/postgresql/16/lib
+PG_INSTALL_VERSION_RE = re.compile(r'^/usr/(?:lib|share)/postgresql/([^/]+)/')
+
+# Buildx builder kept alive between builds so its buildkit cache survives
+BUILDER_NAME = 'pg-extensions-builder'
+
+# Fixed parts of the generated Dockerfile
+DOCKERFILE_SYNTAX = "# syntax=docker/dockerfile:1.6"
+BASE_IMAGE_COMMENT = "# Use PostgreSQL 16 specifically until the extensions support 17 or newer"
+BUILDER_ARG_LINES = (
+    "# amd64 and arm64 have been tested. Others may work but you need to verify",
+    "ARG TARGETARCH",
+    "ARG DEBIAN_FRONTEND=noninteractive",
+    "",
+)
+CMD_LINES = (
+    "# Set the default command to run when starting the container",
+    'CMD ["postgres"]',
+)
+
+def _load_config(path: str) -> Dict:
+    """Parse a YAML config file with the fastest parser available."""
+    with open(path, 'r') as f:
+        content = f.read()
+    if yaml_rs is not None:
+        return yaml_rs.loads(content)
+    # Fall back to the libyaml C bindings when PyYAML was built with them
+    return yaml.load(content, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def _fetch_github_release_assets(owner: str, repo: str) -> List[Dict]:
+    """Get the assets of a repo's latest GitHub release, reusing the cached copy on a 304 or any failure."""
+    key = f"{owner}/{repo}"
+    try:
+        with open(RELEASE_CACHE_FILE, 'r') as f:
+            cache = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    cached = cache.get(key)
+
+    request = urllib.request.Request(
+        f"https://api.github.com/repos/{owner}/{repo}/releases/latest",
+        headers={'Accept': 'application/vnd.github+json'}
+    )
+    if cached:
+        request.add_header('If-None-Match', cached['etag'])
+
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            release = json.load(response)
+            etag = response.headers.get('ETag')
+    except OSError as e:
+        # HTTPError covers both the 304 and rate limiting; URLError covers being offline
+        if not cached:
+            raise
+        if not (isinstance(e, urllib.error.HTTPError) and e.code == 304):
+            logging.warning(f"Could not check the latest {key} release ({e}), using the cached one")
+        return cached['assets']
+
+    assets = [
+        {
+            'name': asset['name'],
+            'url': asset['browser_download_url'],
+            # GitHub reports digests as "sha256:<hex>" for newer uploads only
+            'sha256': (asset.get('digest') or '').removeprefix('sha256:') or None,
+        }
+        for asset in release['assets']
+    ]
+    if etag:
+        cache[key] = {'etag': etag, 'assets': assets}
+        os.makedirs(os.path.dirname(RELEASE_CACHE_FILE), exist_ok=True)
+        with open(RELEASE_CACHE_FILE, 'w') as f:
+            json.dump(cache, f)
+    return assets
+
+def _latest_git_release_tag(url: str) -> str:
+    """Find the highest x.y.z release tag of a git repository without cloning it."""
+    output = subprocess.run(['git', 'ls-remote', '--tags', '--refs', url],
+                            check=True, capture_output=True, text=True, timeout=60).stdout
+    versions = RELEASE_TAG_RE.findall(output)
+    if not versions:
+        raise ValueError(f"No release tags found in {url}")
+    return max(versions, key=lambda version: tuple(int(part) for part in version.split('.')))
+
 class DockerfileGenerator:
     def __init__(self, config_file: str):
-        with open(config_file, 'r') as f:
-            self.config = yaml.safe_load(f)
+        self.config = _load_config(config_file)
         self.validate_config()
 
+    @classmethod
+    def from_file(cls, config_file: str) -> 'DockerfileGenerator':
+        """Return a generator for the config file, reusing it while the file is unchanged."""
+        stat = os.stat(config_file)
+        return cls._from_file(os.path.abspath(config_file), stat.st_mtime_ns, stat.st_size)
+
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _from_file(cls, path: str, mtime_ns: int, size: int) -> 'DockerfileGenerator':
+        """Build a generator; the stat fields only serve as part of the cache key."""
+        return cls(path)
+
+    @functools.cached_property
+    def dockerfile(self) -> str:
+        """The generated Dockerfile content, computed once per generator."""
+        return self.generate_dockerfile()
+
     def validate_config(self):
         """Basic validation of the configuration file."""
         required_fields = ['version', 'postgres_version', 'base_image', 'extensions']
         for field in required_fields:
             if field not in self.config:
                 raise ValueError(f"Missing required field: {field}")
+        for ext_name, ext_config in self.config['extensions'].items():
+            if not ext_config.get('install_artifacts'):
+                raise ValueError(f"Missing install_artifacts for extension: {ext_name}")
+            for artifact in ext_config['install_artifacts']:
+                match = PG_INSTALL_VERSION_RE.match(artifact)
+                if match and match.group(1) != str(self.config['postgres_version']):
+                    raise ValueError(f"install_artifacts path {artifact} for extension {ext_name} doesn't match "
+                                     f"postgres_version {self.config['postgres_version']}")
+            if 'search_path' in ext_config:
+                raise ValueError(f"search_path for extension {ext_name} belongs under postgres_config.search_path")
+            parallel = ext_config.get('build', {}).get('parallel', True)
+            if not isinstance(parallel, bool):
+                try:
+                    int(parallel)
+                except (TypeError, ValueError):
+                    raise ValueError(f"Invalid build.parallel for extension {ext_name}: {parallel!r} "
+                                     "(expected true, false or a job count)")
 
     def generate_dockerfile(self) -> str:
         """Generate the Dockerfile content based on the configuration."""
-        lines = []
+        sio = io.StringIO()
+        apt_deps = self.config.get('global_dependencies', {}).get('apt', {})
+        build_deps = apt_deps.get('build', [])
+        runtime_deps = apt_deps.get('runtime', [])
         
+        # Cache mounts need the BuildKit Dockerfile frontend; this must be the first line
+        self._emit(sio, DOCKERFILE_SYNTAX)
+
         # Base image with comment
-        lines.append("# Use PostgreSQL 16 specifically until the extensions support 17 or newer")
-        lines.append(f"FROM {self.config['base_image']}")
-        lines.append("")
+        self._emit(sio, BASE_IMAGE_COMMENT, f"FROM {self.config['base_image']} AS builder", "")
         
         # Architecture argument
-        lines.append("# amd64 and arm64 have been tested. Others may work but you need to verify")
-        lines.append("ARG TARGETARCH")
-        lines.append("")
+        self._emit(sio, *BUILDER_ARG_LINES)
         
+        # The builder stage is thrown away, so nothing needs cleaning up here. The base image's
+        # docker-clean hook would empty the apt cache mount, so it is dropped here
+        fragments = [[DROP_DOCKER_CLEAN]]
+
         # Global dependencies
-        if 'global_dependencies' in self.config:
-            deps = self.config['global_dependencies']
-            if 'apt' in deps:
-                build_deps = deps['apt'].get('build', [])
-                runtime_deps = deps['apt'].get('runtime', [])
-                if build_deps or runtime_deps:
-                    lines.extend(self._generate_apt_install(build_deps + runtime_deps))
-                    lines.append("")
+        if build_deps or runtime_deps:
+            fragments.append(self._generate_apt_install(build_deps + runtime_deps, eatmydata=True))
 
         # Update certificates if needed
-        if 'ca-certificates' in self.config['global_dependencies']['apt'].get('runtime', []):
-            lines.append("RUN update-ca-certificates")
-            lines.append("")
+        if 'ca-certificates' in runtime_deps:
+            fragments.append(["update-ca-certificates"])
 
-        # Process each extension
+        self._emit(sio, "# Install build dependencies")
+        self._emit_run(sio, fragments, mounts=APT_CACHE_MOUNTS)
+        self._emit(sio, "")
+
+        # One RUN per extension, so changing one extension doesn't rebuild the others. The apt
+        # mounts are kept because package installs resolve their dependencies from the cached lists
         for ext_name, ext_config in self.config['extensions'].items():
-            lines.extend(self._generate_installation(ext_name, ext_config))
-            lines.append("")
+            self._emit_run(sio, [self._generate_installation(ext_name, ext_config)], mounts=APT_CACHE_MOUNTS)
+            self._emit(sio, "")
+
+        # Runtime stage only gets the runtime packages and the installed extension files
+        self._emit(sio, "# Runtime image without the build toolchain", f"FROM {self.config['base_image']}",
+                   "ARG DEBIAN_FRONTEND=noninteractive", "")
+
+        if runtime_deps:
+            # apt lists live on the cache mount, so there is nothing to clean up afterwards. The mount
+            # is shared with the builder stage, so docker-clean is only put back once apt is done
+            fragments = [[SET_ASIDE_DOCKER_CLEAN], self._generate_apt_install(runtime_deps)]
+            if 'ca-certificates' in runtime_deps:
+                fragments.append(["update-ca-certificates"])
+            fragments.append([RESTORE_DOCKER_CLEAN])
+            self._emit(sio, "# Install runtime dependencies")
+            self._emit_run(sio, fragments, mounts=APT_CACHE_MOUNTS)
+            self._emit(sio, "")
 
-        # Cleanup
-        lines.extend(self._generate_cleanup())
+        self._emit_artifact_copies(sio)
+        self._emit(sio, "")
         
         # CMD
-        lines.append("# Set the default command to run when starting the container")
-        lines.append('CMD ["postgres"]')
+        self._emit(sio, *CMD_LINES)
         
-        return '\n'.join(lines)
+        return sio.getvalue()
 
-    def _generate_apt_install(self, packages: List[str]) -> List[str]:
-        """Generate apt-get install commands."""
+    @staticmethod
+    def _emit(sio: io.StringIO, *lines: str):
+        """Write lines to the Dockerfile being generated."""
+        for line in lines:
+            sio.write(line)
+            sio.write("\n")
+
+    def _make_jobs_flag(self, build_config: Dict) -> str:
+        """Return the make -j flag for build.parallel (default: one job per CPU)."""
+        parallel = build_config.get('parallel', True)
+        if parallel is True:
+            return ' -j"$(nproc)"'
+        if parallel is False or int(parallel) <= 1:
+            return ''
+        return f" -j{int(parallel)}"
+
+    def _emit_artifact_copies(self, sio: io.StringIO):
+        """Write COPY instructions bringing each extension's installed files over from the builder."""
+        # One COPY per destination directory keeps the number of layers down
+        by_directory = {}
+        for ext_config in self.config['extensions'].values():
+            for artifact in ext_config['install_artifacts']:
+                by_directory.setdefault(os.path.dirname(artifact), []).append(artifact)
+
+        self._emit(sio, "# Copy the installed extensions from the builder stage")
+        for directory, artifacts in by_directory.items():
+            self._emit(sio, f"COPY --from=builder {' '.join(artifacts)} {directory}/")
+
+    def _emit_run(self, sio: io.StringIO, fragments: List[List[str]], mounts=()):
+        """Write command fragments as a single RUN instruction, with optional --mount flags.
+
+        A fragment is a list of lines: comments, a first command line, then continuation
+        lines that are already indented and end with a backslash where needed.
+        """
+        # Lines since the last command line are held back until we know whether another
+        # command follows, in which case that command line gets chained with &&
+        pending = []
+        for fragment in fragments:
+            first = True
+            for line in fragment:
+                if line.startswith('#'):
+                    if pending:
+                        pending.append("    " + line)
+                    else:
+                        self._emit(sio, line)
+                    continue
+                if first:
+                    if not pending and mounts:
+                        self._emit(sio, "RUN " + " ".join(mounts) + " \\")
+                        line = "    " + line
+                    elif not pending:
+                        line = "RUN " + line
+                    else:
+                        pending[0] += " && \\"
+                        line = "    " + line
+                    first = False
+                self._emit(sio, *pending)
+                pending = [line]
+        self._emit(sio, *pending)
+
+    def _generate_apt_install(self, packages: List[str], eatmydata: bool = False) -> List[str]:
+        """Generate apt-get install commands, optionally skipping fsync with eatmydata (throwaway stages only)."""
         if not packages:
             return []
-            
-        return [
-            "RUN apt-get update && apt-get install -y --no-install-recommends \\",
-            "    " + " \\\n    ".join(sorted(packages))
-        ]
+
+        packages = sorted(packages)
+        if eatmydata:
+            install = [
+                "apt-get update && apt-get install -y --no-install-recommends eatmydata && \\",
+                "    eatmydata apt-get install -y --no-install-recommends \\"
+            ]
+        else:
+            install = ["apt-get update && apt-get install -y --no-install-recommends \\"]
+        return (
+            install
+            + [f"    {package} \\" for package in packages[:-1]]
+            + [f"    {packages[-1]}"]
+        )
 
     def _generate_installation(self, name: str, config: Dict) -> List[str]:
         """Generate installation commands for an extension."""
@@ -95,22 +334,63 @@ class DockerfileGenerator:
         """Generate installation commands for a package-type extension."""
         pkg_config = config['package']
         if pkg_config['repository']['type'] == 'github':
+            # Pin the release asset now so the build step is cacheable and doesn't hit the GitHub API
             repo = pkg_config['repository']
-            return [
-                "RUN LATEST_RELEASE=$(wget -qO - "
-                f"https://api.github.com/repos/{repo['owner']}/{repo['repo']}/releases/latest) && \\",
-                "    if [ \"$TARGETARCH\" = \"arm64\" ]; then \\",
-                f"        ARCH_PATTERN=\"{config['architecture_map']['arm64']}\"; \\",
+            try:
+                release_assets = _fetch_github_release_assets(repo['owner'], repo['repo'])
+                assets = {
+                    arch: self._match_release_asset(release_assets, repo, config['architecture_map'][arch])
+                    for arch in ('arm64', 'amd64')
+                }
+            except (OSError, ValueError) as e:
+                logging.warning(f"Could not resolve the {pkg_config['name']} release ({e}), "
+                                "it will be looked up during the build instead")
+                return self._generate_release_lookup(config)
+
+            package_file = f"/tmp/{pkg_config['name']}.deb"
+            lines = [
+                "if [ \"$TARGETARCH\" = \"arm64\" ]; then \\",
+                f"        ASSET_URL=\"{assets['arm64']['url']}\"; ASSET_SHA256=\"{assets['arm64']['sha256'] or ''}\"; \\",
                 "    else \\",
-                f"        ARCH_PATTERN=\"{config['architecture_map']['amd64']}\"; \\",
+                f"        ASSET_URL=\"{assets['amd64']['url']}\"; ASSET_SHA256=\"{assets['amd64']['sha256'] or ''}\"; \\",
                 "    fi && \\",
-                "    wget -q $(echo $LATEST_RELEASE | jq -r --arg ARCH \"$ARCH_PATTERN\" '.assets[] | select(.name | contains($ARCH)) | .browser_download_url') && \\",
-                f"    apt install -y --no-install-recommends ./{pkg_config['name']}_*_${{TARGETARCH}}.deb && \\",
-                f"    rm -f {pkg_config['name']}_*_${{TARGETARCH}}.deb"
+                f"    wget -q -O {package_file} \"$ASSET_URL\" && \\",
             ]
+            if all(asset['sha256'] for asset in assets.values()):
+                lines.append(f"    echo \"$ASSET_SHA256  {package_file}\" | sha256sum -c - && \\")
+            lines.extend([
+                f"    apt install -y --no-install-recommends {package_file} && \\",
+                f"    rm -f {package_file}"
+            ])
+            return lines
         else:
             return []
 
+    def _match_release_asset(self, assets: List[Dict], repo: Dict, arch: str) -> Dict:
+        """Find the release asset matching the repository's asset_pattern for an architecture."""
+        pattern = re.compile(repo['asset_pattern'].format(arch=arch))
+        for asset in assets:
+            if pattern.fullmatch(asset['name']):
+                return asset
+        raise ValueError(f"No release asset of {repo['owner']}/{repo['repo']} matches {pattern.pattern}")
+
+    def _generate_release_lookup(self, config: Dict) -> List[str]:
+        """Generate commands that look up the latest release asset while the image builds."""
+        pkg_config = config['package']
+        repo = pkg_config['repository']
+        return [
+            "LATEST_RELEASE=$(wget -qO - "
+            f"https://api.github.com/repos/{repo['owner']}/{repo['repo']}/releases/latest) && \\",
+            "    if [ \"$TARGETARCH\" = \"arm64\" ]; then \\",
+            f"        ARCH_PATTERN=\"{config['architecture_map']['arm64']}\"; \\",
+            "    else \\",
+            f"        ARCH_PATTERN=\"{config['architecture_map']['amd64']}\"; \\",
+            "    fi && \\",
+            "    wget -q $(echo $LATEST_RELEASE | jq -r --arg ARCH \"$ARCH_PATTERN\" '.assets[] | select(.name | contains($ARCH)) | .browser_download_url') && \\",
+            f"    apt install -y --no-install-recommends ./{pkg_config['name']}_*_${{TARGETARCH}}.deb && \\",
+            f"    rm -f {pkg_config['name']}_*_${{TARGETARCH}}.deb"
+        ]
+
     def _generate_source_installation(self, config: Dict) -> List[str]:
         """Generate installation commands for a source-type extension."""
         src_config = config['source']
@@ -118,104 +398,136 @@ class DockerfileGenerator:
         lines = []
         
         if src_config['repository']['type'] == 'git':
+            repo = src_config['repository']
+            # Shallow, single-branch clones unless the config asks for more history (depth: 0 for all of it)
             clone_cmd = "git clone"
-            if 'depth' in src_config['repository']:
-                clone_cmd += f" --depth {src_config['repository']['depth']}"
-            if 'branch' in src_config['repository']:
-                clone_cmd += f" --branch {src_config['repository']['branch']}"
-            clone_cmd += f" {src_config['repository']['url']} {build_config['directory']}"
+            depth = repo.get('depth', 1)
+            if depth:
+                clone_cmd += f" --depth {depth} --shallow-submodules"
+            clone_cmd += " --single-branch --no-tags"
+            jobs = self._make_jobs_flag(build_config)
             
             # Handle AGE-specific commands
             if 'age' in build_config['directory']:
+                if 'branch' in repo:
+                    clone_cmd += f" --branch {repo['branch']}"
+                clone_cmd += f" {repo['url']} {build_config['directory']}"
                 lines.extend([
-                    f"RUN if [ -d \"{build_config['directory']}\" ]; "
+                    f"if [ -d \"{build_config['directory']}\" ]; "
                     f"then rm -rf {build_config['directory']}; fi && \\",
                     f"    {clone_cmd} && \\",
                     f"    cd {build_config['directory']} && \\",
-                    "    make PG_CONFIG=/usr/bin/pg_config && \\",
+                    f"    make{jobs} PG_CONFIG=/usr/bin/pg_config && \\",
                     "    make install PG_CONFIG=/usr/bin/pg_config"
                 ])
             
             # Handle TimescaleDB-specific commands
             elif 'timescaledb' in build_config['directory']:
+                lines.append(
+                    f"if [ -d \"{build_config['directory']}\" ]; "
+                    f"then rm -rf {build_config['directory']}; fi && \\"
+                )
+                # Clone the latest release tag directly instead of checking it out after a full clone.
+                # The tag is pinned now so a new release changes the RUN and invalidates its cache
+                branch = repo.get('branch')
+                if branch is None:
+                    try:
+                        branch = _latest_git_release_tag(repo['url'])
+                    except (OSError, ValueError, subprocess.SubprocessError) as e:
+                        logging.warning(f"Could not resolve the latest tag of {repo['url']} ({e}), "
+                                        "it will be looked up during the build instead")
+                if branch is not None:
+                    clone_cmd += f" --branch {branch}"
+                else:
+                    lines.append(
+                        f"    LATEST_TAG=$(git ls-remote --tags --refs {repo['url']} | sed 's#.*refs/tags/##' | "
+                        "grep -E '^[0-9]+\\.[0-9]+\\.[0-9]+$' | sort -V | tail -n 1) && \\"
+                    )
+                    clone_cmd += " --branch ${LATEST_TAG}"
+                clone_cmd += f" {repo['url']} {build_config['directory']}"
                 lines.extend([
-                    f"RUN if [ -d \"{build_config['directory']}\" ]; "
-                    f"then rm -rf {build_config['directory']}; fi && \\",
                     f"    {clone_cmd} && \\",
                     "    cd /timescaledb && \\",
-                    "    LATEST_TAG=$(curl -s https://api.github.com/repos/timescale/timescaledb/releases/latest | jq -r .tag_name) && \\",
-                    "    git checkout ${LATEST_TAG} && \\",
                     "    ./bootstrap -DPG_CONFIG=/usr/bin/pg_config -DAPACHE_ONLY=1 && \\",
                     "    cd build && \\",
-                    "    make && \\",
+                    f"    make{jobs} && \\",
                     "    make install"
                 ])
         
         return lines
 
-    def _generate_cleanup(self) -> List[str]:
-        """Generate cleanup commands."""
-        # Specific list of packages to remove, matching the original exactly
-        cleanup_packages = [
-            'apt-utils', 'bison', 'build-essential', 'cmake', 'curl', 'flex',
-            'git', 'gnupg', 'libreadline-dev', 'postgresql-server-dev-16', 'zlib1g-dev'
-        ]
-        
-        return [
-            "# Clean up",
-            "RUN apt-get remove -y " + " ".join(sorted(cleanup_packages)) + " && \\",
-            "    apt-get autoremove -y && \\",
-            "    apt-get clean && \\",
-            "    rm -rf /var/lib/apt/lists/*",
-            ""
-        ]
-
     def get_postgres_config(self) -> Dict:
-        """Extract PostgreSQL configuration from extensions."""
-        config = {
-            'shared_preload_libraries': [],
-            'search_path': []
+        """Extract PostgreSQL configuration, without duplicates and in config order.
+
+        Preload libraries come from the extensions; search_path comes only from the top-level
+        postgres_config section, since its order matters across extensions.
+        """
+        shared = self.config.get('postgres_config') or {}
+        return {
+            'shared_preload_libraries': list(dict.fromkeys(itertools.chain.from_iterable(
+                ext.get('shared_preload_libraries', []) for ext in self.config['extensions'].values()
+            ))),
+            'search_path': list(dict.fromkeys(shared.get('search_path', []))),
         }
-        
-        for ext_config in self.config['extensions'].values():
-            if 'shared_preload_libraries' in ext_config:
-                config['shared_preload_libraries'].extend(ext_config['shared_preload_libraries'])
-            if 'search_path' in ext_config:
-                config['search_path'].extend(ext_config['search_path'])
-                
-        return config
     
 def is_port_in_use(port):
-    """Check if a port is in use."""
+    """Check if a port is in use by trying to bind it on the loopback interface."""
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex(('localhost', port)) == 0
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 0)
+        try:
+            s.bind(('127.0.0.1', port))
+        except OSError as e:
+            return e.errno == errno.EADDRINUSE
+        return False
 
-def run_command(command, check=True, shell=False):
-    """Execute a shell command and return its output."""
+def run_command(command, check=True, input=None, capture=True):
+    """Execute a command given as an argv list and return its output (None when capture is False)."""
     try:
-        result = subprocess.run(command, check=check, shell=shell, text=True, capture_output=True)
+        if not capture:
+            # Discard stdout but keep stderr so failures can still be reported
+            subprocess.run(command, check=check, text=True, input=input,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            return None
+        result = subprocess.run(command, check=check, text=True, capture_output=True, input=input)
         return result.stdout.strip()
     except subprocess.CalledProcessError as e:
         logging.error(f"Command failed: {e}")
         logging.error(f"Error output: {e.stderr}")
         raise
 
+def run_command_quiet(command):
+    """Execute a command only for its exit status, discarding all output."""
+    return subprocess.call(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def docker_inspect(container_name: str) -> Optional[Dict]:
+    """Inspect a container once for its state and volumes, or return None if it doesn't exist."""
+    # A missing container makes docker exit non-zero and print [] on stdout, so an empty
+    # result below (not empty output) is what means "doesn't exist"
+    output = run_command(['docker', 'container', 'inspect', container_name], check=False)
+    try:
+        details = json.loads(output) if output else []
+    except json.JSONDecodeError:
+        return None
+    if not details:
+        return None
+
+    detail = details[0]
+    return {
+        'running': detail['State']['Running'],
+        'volumes': [mount['Name'] for mount in detail.get('Mounts') or []
+                    if mount.get('Type') == 'volume'],
+    }
+
 def is_container_running(container_name):
     """Check if a container is running."""
-    try:
-        output = run_command(['docker', 'container', 'inspect', '-f', '{{.State.Running}}', container_name])
-        return output.lower() == 'true'
-    except subprocess.CalledProcessError:
-        return False
+    container_info = docker_inspect(container_name)
+    return container_info is not None and container_info['running']
 
 def does_volume_exist(volume_name):
     """Check if a Docker volume exists."""
-    try:
-        run_command(['docker', 'volume', 'inspect', volume_name])
-        return True
-    except subprocess.CalledProcessError:
-        return False
+    return run_command_quiet(['docker', 'volume', 'inspect', volume_name]) == 0
     
+@functools.lru_cache(maxsize=None)
 def get_system_architecture():
     """Detect system architecture and return appropriate Docker platform. Others may work but you will have to experiment and modify."""
     machine = platform.machine().lower()
@@ -226,152 +538,147 @@ def get_system_architecture():
     else:
         raise Exception(f"Unsupported architecture: {machine}")
 
-def get_container_volume(container_name):
-    """Get volume name associated with a container."""
-    try:
-        # Get volume mounts for the container
-        inspect_cmd = ['docker', 'container', 'inspect', 
-                      '-f', '{{range .Mounts}}{{if eq .Type "volume"}}{{.Name}}{{end}}{{end}}', 
-                      container_name]
-        volume_name = run_command(inspect_cmd)
-        return volume_name if volume_name else None
-    except subprocess.CalledProcessError:
-        return None
-    
 def cleanup_buildx():
     """Clean up all buildx resources."""
     try:
-        # Get all builder instances
-        builders = run_command(['docker', 'buildx', 'ls']).split('\n')
-        for builder in builders:
-            if 'pg-extensions-builder' in builder:
-                # Remove the builder
-                run_command(['docker', 'buildx', 'rm', 'pg-extensions-builder'], check=False)
-        
-        # Find and remove any lingering buildkit containers
-        containers = run_command(['docker', 'ps', '-a', '--filter', 'name=buildx_buildkit_pg-extensions-builder', '--format', '{{.Names}}']).split('\n')
-        for container in containers:
-            if container:  # Skip empty strings
-                run_command(['docker', 'rm', '-f', container], check=False)
+        # Removing the builder also tears down its buildkit container; a missing builder is harmless
+        run_command(['docker', 'buildx', 'rm', '-f', BUILDER_NAME], check=False, capture=False)
     except Exception as e:
         logging.warning(f"Error during buildx cleanup: {e}")
 
+def ensure_builder():
+    """Reuse the buildx builder if it already exists, otherwise create it."""
+    if run_command_quiet(['docker', 'buildx', 'inspect', BUILDER_NAME]) == 0:
+        logging.info("Reusing existing builder instance...")
+    else:
+        logging.info("Creating new builder instance...")
+        run_command(['docker', 'buildx', 'create', '--name', BUILDER_NAME, '--driver', 'docker-container'],
+                    capture=False)
+
 
-def build_image(config_file='postgres-extensions.yaml', tag='postgres-extensions:latest', platform=None):
+def write_dockerfile(content, path=DOCKERFILE_PATH):
+    """Write the Dockerfile unless it already has this exact content, so its mtime only changes with it."""
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                logging.info(f"{path} is up to date")
+                return False
+    except FileNotFoundError:
+        pass
+
+    # Write through a temp file so an interrupted write never leaves a truncated Dockerfile behind
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp',
+                                     delete=False) as f:
+        f.write(content)
+    os.replace(f.name, path)
+    return True
+
+def build_image(config_file='postgres-extensions.yaml', tag='postgres-extensions:latest', platform=None,
+                generator=None, fresh_builder=False, no_cache=False):
     """Build the Docker image using buildx."""
     # Generate Dockerfile content
-    generator = DockerfileGenerator(config_file)
-    dockerfile_content = generator.generate_dockerfile()
+    if generator is None:
+        generator = DockerfileGenerator.from_file(config_file)
+    dockerfile_content = generator.dockerfile
     
     # Write to temporary Dockerfile
-    dockerfile_path = 'PostgresWithExtensions.dockerfile'
-    with open(dockerfile_path, 'w') as f:
-        f.write(dockerfile_content)
+    dockerfile_path = DOCKERFILE_PATH
+    write_dockerfile(dockerfile_content, dockerfile_path)
 
     if platform is None:
         platform = get_system_architecture()
     
     logging.info(f"Building Docker image for platform {platform}...")
     
-    # Clean up any existing builder first
-    cleanup_buildx()
+    # The builder is left running afterwards; use the cleanup-builder command to remove it
+    if fresh_builder:
+        logging.info("Removing builder before build...")
+        cleanup_buildx()
+    ensure_builder()
     
-    # Create new builder
-    builder_name = 'pg-extensions-builder'
-    logging.info("Creating new builder instance...")
-    run_command(['docker', 'buildx', 'create', '--name', builder_name, '--use'])
+    # Build the image with verbose output. The builder is named explicitly rather than made the
+    # default, so plain `docker build` elsewhere keeps using the user's own builder
+    build_cmd = [
+        'docker', 'buildx', 'build',
+        '--builder', BUILDER_NAME,
+        '-f', dockerfile_path,  # Use the generated dockerfile path
+        '--platform', platform,
+        '-t', tag,
+        '.',
+        '--load',
+        '--progress=plain'  # Enable verbose output
+    ]
+    # Layers from previous builds are reused from the kept builder's own cache, which BuildKit
+    # garbage-collects, unlike a local cache export that only ever grows
+    if no_cache:
+        # Skips the builder's cache, but the result is still cached for the next build
+        build_cmd.append('--no-cache')
     
-    try:
-        # Build the image with verbose output
-        build_cmd = [
-            'docker', 'buildx', 'build',
-            '-f', dockerfile_path,  # Use the generated dockerfile path
-            '--platform', platform,
-            '-t', tag,
-            '.',
-            '--load',
-            '--progress=plain'  # Enable verbose output
-        ]
-        
-        # Use Popen to stream output in real-time
-        process = subprocess.Popen(
-            build_cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True
-        )
-        
-        # Stream the output
-        for line in process.stdout: # type: ignore
-            print(line, end='')
-        
-        process.wait()
-        if process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, build_cmd)
-            
-        logging.info("Image built successfully")
-    finally:
-        # Clean up all buildx resources
-        logging.info("Cleaning up builder...")
-        cleanup_buildx()
+    # Inherit stdout/stderr so the build log goes straight to the terminal without
+    # passing through Python or filling up a pipe buffer
+    subprocess.run(build_cmd, check=True)
 
+    logging.info("Image built successfully")
 
-def get_postgres_version(container_name='postgres'):
-    """Get PostgreSQL major version number from the container."""
-    try:
-        version_output = run_command(
-            ['docker', 'exec', container_name, 'psql', '--version']
-        )
-        # Parse version string (e.g., "psql (PostgreSQL) 16.1" or "psql (PostgreSQL) 17.0")
-        match = re.search(r'(\d+)\.', version_output)
-        if match:
-            major_version = match.group(1)
+
+def parse_postgres_version(version_output):
+    """Parse the major version out of SHOW server_version_num output."""
+    # server_version_num is an integer like 160001 (16.1) or 170000 (17.0)
+    for line in version_output.splitlines():
+        if line.strip().isdigit():
+            major_version = str(int(line.strip()) // 10000)
             logging.info(f"Detected PostgreSQL version: {major_version}")
             return major_version
-        else:
-            raise ValueError("Could not parse PostgreSQL version")
-    except Exception as e:
-        logging.error(f"Failed to detect PostgreSQL version: {e}")
-        raise
+    raise ValueError("Could not parse PostgreSQL version")
 
-def wait_for_postgres(container_name='postgres-extensions', max_attempts=30, delay=2):
-    """Wait for PostgreSQL to become ready."""
+def wait_for_postgres(container_name='postgres-extensions', max_attempts=30, initial_delay=0.1, max_delay=2):
+    """Wait for PostgreSQL to become ready, backing off exponentially between attempts."""
     logging.info("Waiting for PostgreSQL to be ready...")
+
+    # Poll every 100ms from inside the container (up to 30s) so the host only pays for one exec.
+    # Probing over TCP skips the entrypoint's temporary init server, which only listens on the unix socket
+    if run_command_quiet(['docker', 'exec', container_name, 'bash', '-c',
+                          'for i in $(seq 1 300); do pg_isready -h 127.0.0.1 -U postgres -q && exit 0; sleep 0.1; done; '
+                          'exit 1']) == 0:
+        logging.info("PostgreSQL is ready.")
+        return True
+    logging.info("PostgreSQL is not ready yet. Falling back to polling from the host...")
+
     for attempt in range(max_attempts):
-        try:
-            run_command(['docker', 'exec', container_name, 'pg_isready', '-U', 'postgres'])
+        if run_command_quiet(['docker', 'exec', container_name, 'pg_isready', '-h', '127.0.0.1', '-U', 'postgres']) == 0:
             logging.info("PostgreSQL is ready.")
             return True
-        except subprocess.CalledProcessError:
-            logging.info(f"PostgreSQL is not ready yet. Attempt {attempt + 1}/{max_attempts}")
-            time.sleep(delay)
+        logging.info(f"PostgreSQL is not ready yet. Attempt {attempt + 1}/{max_attempts}")
+        time.sleep(min(max_delay, initial_delay * 2 ** attempt))
     logging.error("PostgreSQL failed to become ready in time.")
     return False
 
 def remove_container(container_name='postgres-extensions', remove_volume=False):
     """Remove existing container and optionally its volume."""
-    container_exists = False
+    if not remove_volume:
+        # docker rm -f is a harmless no-op when the container doesn't exist
+        logging.info(f"Removing container {container_name} if it exists...")
+        run_command(['docker', 'rm', '-f', container_name], check=False, capture=False)
+        return
+
     volume_name = None
-    
-    try:
-        run_command(['docker', 'container', 'inspect', container_name])
-        container_exists = True
-        if remove_volume:
-            # Get the volume name from the container before removing it
-            volume_name = get_container_volume(container_name)
-    except subprocess.CalledProcessError:
-        pass
+
+    # A single inspect gives us both existence and the volume to remove
+    container_info = docker_inspect(container_name)
+    container_exists = container_info is not None
+    if container_exists and container_info['volumes']:
+        volume_name = container_info['volumes'][0]
 
     if container_exists:
         logging.info(f"Removing container {container_name}...")
-        run_command(['docker', 'rm', '-f', container_name], check=False)
+        run_command(['docker', 'rm', '-f', container_name], check=False, capture=False)
     else:
         logging.info(f"Container {container_name} does not exist. Nothing to remove.")
     
-    if remove_volume and volume_name:
+    if volume_name:
         if does_volume_exist(volume_name):
             logging.info(f"Removing volume {volume_name}...")
-            run_command(['docker', 'volume', 'rm', '-f', volume_name], check=False)
+            run_command(['docker', 'volume', 'rm', '-f', volume_name], check=False, capture=False)
         else:
             logging.info(f"Volume {volume_name} does not exist. Nothing to remove.")
 
@@ -380,22 +687,18 @@ def remove_container(container_name='postgres-extensions', remove_volume=False):
 def start_postgres_container(
     container_name='postgres-extensions',
     image='postgres-extensions:latest',
-    port=None,
-    password=None,
-    volume_name=None
+    port='5432',
+    password='postgres',
+    volume_name='postgres-extensions-data'
 ):
     """Start the PostgreSQL container with the specified configuration."""
-    if password is None:
-        password = os.getenv('POSTGRES_PASSWORD', 'postgres')
-    
-    if port is None:
-        port = os.getenv('POSTGRES_PORT', '5432')
-        
-    if volume_name is None:
-        volume_name = os.getenv('POSTGRES_VOLUME', 'postgres-extensions-data')
-    
+    # The preflight probes are independent, so run them at the same time
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        port_check = executor.submit(is_port_in_use, int(port))
+        image_check = executor.submit(run_command_quiet, ['docker', 'image', 'inspect', image])
+
     # Check if port is in use
-    if is_port_in_use(int(port)):
+    if port_check.result():
         raise Exception(
             f"Port {port} is already in use. This might be another PostgreSQL instance.\n"
             f"Please either:\n"
@@ -403,6 +706,10 @@ def start_postgres_container(
             f"2. Set a different port in your .env file (POSTGRES_PORT=<port>)"
         )
 
+    # The image is only ever built locally, so docker run would fail trying to pull it
+    if image_check.result() != 0:
+        raise Exception(f"Image {image} not found. Run the build command first.")
+
     logging.info(f"Starting PostgreSQL container using image {image}...")
     cmd = [
         'docker', 'run', '--name', container_name,
@@ -415,37 +722,41 @@ def start_postgres_container(
     run_command(cmd)
     return wait_for_postgres(container_name)
 
-def configure_extensions(container_name='postgres'):
+def configure_extensions(container_name='postgres', dbname='postgres', user='postgres',
+                         config_file='postgres-extensions.yaml'):
     """Configure AGE and other extensions in PostgreSQL."""
     logging.info("Configuring PostgreSQL extensions...")
+    pg_config = DockerfileGenerator.from_file(config_file).get_postgres_config()
+    preload_libraries = ", ".join(f"'{library}'" for library in pg_config['shared_preload_libraries'])
+    search_path = ", ".join(pg_config['search_path'])
+    # An empty list isn't valid after SET, so reset the setting to its default instead
+    settings_sql = "\n".join(
+        f"ALTER SYSTEM SET {name} = {value};" if value else f"ALTER SYSTEM RESET {name};"
+        for name, value in (('shared_preload_libraries', preload_libraries), ('search_path', search_path))
+    )
     
-    # Get PostgreSQL version
-    pg_version = get_postgres_version(container_name)
-    pg_lib_path = f"/usr/lib/postgresql/{pg_version}/lib"
-    
-    # Configure AGE plugin directory
-    logging.info(f"Setting up AGE plugin directory for PostgreSQL {pg_version}...")
-    run_command(['docker', 'exec', container_name, 'bash', '-c',
-                f"mkdir -p {pg_lib_path}/plugins && "
-                f"ln -s {pg_lib_path}/age.so {pg_lib_path}/plugins/age.so"])
-
-    # Configure shared_preload_libraries
-    logging.info("Configuring shared_preload_libraries...")
-    run_command(['docker', 'exec', container_name, 'bash', '-c',
-                "echo \"shared_preload_libraries = 'age,timescaledb,vectors'\" >> "
-                "/var/lib/postgresql/data/postgresql.conf"])
-    run_command([
-                'docker', 'exec', container_name, 'bash', '-c',
-                'echo "search_path = \'ag_catalog, \\"$user\\", public, vectors\'" >> '
-                '/var/lib/postgresql/data/postgresql.conf'
-            ])
+    # Version detection and the configuration changes share one psql session
+    with PsqlSession(container_name, dbname, user) as session:
+        # Get PostgreSQL version
+        pg_version = parse_postgres_version(session.execute("SHOW server_version_num;"))
+        pg_lib_path = f"/usr/lib/postgresql/{pg_version}/lib"
+        
+        # Configure AGE plugin directory
+        logging.info(f"Setting up AGE plugin directory for PostgreSQL {pg_version}...")
+        run_command(['docker', 'exec', container_name, 'bash', '-c',
+                    f"mkdir -p {pg_lib_path}/plugins && "
+                    f"ln -s {pg_lib_path}/age.so {pg_lib_path}/plugins/age.so"], capture=False)
+
+        # Configure shared_preload_libraries and search_path (written to postgresql.auto.conf)
+        logging.info("Configuring shared_preload_libraries...")
+        session.execute(settings_sql, "Setting shared_preload_libraries and search_path")
 
     # Restart PostgreSQL container
     logging.info("Restarting PostgreSQL container...")
-    run_command(['docker', 'restart', container_name])
+    run_command(['docker', 'restart', container_name], capture=False)
 
     # Wait for PostgreSQL to be ready again
-    return wait_for_postgres()
+    return wait_for_postgres(container_name)
 
 def verify_extensions(container_name='postgres-extensions', dbname='postgres', user='postgres'):
     """Verify that all required extensions are installed and available."""
@@ -459,27 +770,48 @@ def verify_extensions(container_name='postgres-extensions', dbname='postgres', u
     FROM pg_extension 
     WHERE extname IN ('age', 'vectors', 'timescaledb');
     """
-    psql_command = f"docker exec -i {container_name} psql -U {user} -d {dbname} -c {shlex.quote(verify_command)}"
-    result = run_command(psql_command, shell=True)
+    result = run_command(psql_command(container_name, dbname, user), input=verify_command)
     logging.info(f"Installed extensions:\n{result}")
     return result
 
+def test_age_extension(container_name='postgres-extensions', dbname='postgres', user='postgres'):
+    """Test AGE graph creation and deletion."""
+    logging.info("Testing age...")
+    age_test = """
+    SELECT * FROM ag_catalog.create_graph('age_test_graph');
+    SELECT * FROM ag_catalog.drop_graph('age_test_graph', true);
+    """
+    execute_sql(container_name, dbname, user, age_test, "AGE graph creation and deletion")
+    logging.info("age test passed successfully")
+
+def test_timescaledb_extension(container_name='postgres-extensions', dbname='postgres', user='postgres'):
+    """Test TimescaleDB hypertable creation."""
+    logging.info("Testing timescaledb...")
+    timescale_test = """
+    CREATE TABLE tsdb_test_table(time TIMESTAMPTZ NOT NULL, value DOUBLE PRECISION);
+    SELECT create_hypertable('tsdb_test_table', 'time');
+    DROP TABLE tsdb_test_table;
+    """
+    execute_sql(container_name, dbname, user, timescale_test, "TimescaleDB hypertable creation")
+    logging.info("timescaledb test passed successfully")
+
 def test_vectors_extension(container_name='postgres-extensions', dbname='postgres', user='postgres'):
     """Test vectors extension step by step."""
     logging.info("Testing vectors extension...")
     
     steps = [
-        ("DROP TABLE IF EXISTS items;", "Cleaning up any existing items table"),
-        ("CREATE TABLE items (embedding vector(3));", "Creating items table"),
-        ("INSERT INTO items (embedding) SELECT ARRAY[random(), random(), random()]::real[] FROM generate_series(1, 10);", 
+        ("DROP TABLE IF EXISTS vec_items;", "Cleaning up any existing vec_items table"),
+        ("CREATE TABLE vec_items (embedding vector(3));", "Creating vec_items table"),
+        ("INSERT INTO vec_items (embedding) SELECT ARRAY[random(), random(), random()]::real[] FROM generate_series(1, 10);", 
          "Inserting test data"),
-        ("CREATE INDEX ON items USING vectors (embedding vector_l2_ops);", "Creating vector index"),
-        ("SELECT * FROM items ORDER BY embedding <-> '[3,2,1]' LIMIT 5;", "Testing KNN query"),
-        ("DROP TABLE items;", "Cleaning up items table")
+        ("CREATE INDEX ON vec_items USING vectors (embedding vector_l2_ops);", "Creating vector index"),
+        ("SELECT * FROM vec_items ORDER BY embedding <-> '[3,2,1]' LIMIT 5;", "Testing KNN query"),
+        ("DROP TABLE vec_items;", "Cleaning up vec_items table")
     ]
     
-    for sql, description in steps:
-        execute_sql(container_name, dbname, user, sql, description)
+    with PsqlSession(container_name, dbname, user) as session:
+        for sql, description in steps:
+            session.execute(sql, description)
     
     logging.info("Vectors extension test completed successfully")
 
@@ -491,36 +823,38 @@ def test_extensions(container_name='postgres-extensions', dbname='postgres', use
         
     logging.info("Testing extensions functionality...")
     
-    # Test AGE
-    logging.info("Testing age...")
-    age_test = """
-    SELECT * FROM ag_catalog.create_graph('test_graph');
-    SELECT * FROM ag_catalog.drop_graph('test_graph', true);
-    """
-    execute_sql(container_name, dbname, user, age_test, "AGE graph creation and deletion")
-    logging.info("age test passed successfully")
+    # Each test uses its own tables/graphs over its own connection, so they can run concurrently
+    tests = [test_age_extension, test_timescaledb_extension, test_vectors_extension]
+    with ThreadPoolExecutor(max_workers=len(tests)) as executor:
+        futures = {test.__name__: executor.submit(test, container_name, dbname, user) for test in tests}
 
-    # Test TimescaleDB
-    logging.info("Testing timescaledb...")
-    timescale_test = """
-    CREATE TABLE test_table(time TIMESTAMPTZ NOT NULL, value DOUBLE PRECISION);
-    SELECT create_hypertable('test_table', 'time');
-    DROP TABLE test_table;
-    """
-    execute_sql(container_name, dbname, user, timescale_test, "TimescaleDB hypertable creation")
-    logging.info("timescaledb test passed successfully")
+    failures = []
+    for name, future in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            failures.append(f"{name}: {e}")
+    if failures:
+        raise Exception("Extension tests failed:\n" + "\n".join(failures))
 
-    # Test Vectors
-    test_vectors_extension(container_name, dbname, user)
+def psql_command(container_name, dbname, user):
+    """Build the argv for a psql session in the container that reads SQL from stdin."""
+    return [
+        'docker', 'exec', '-i', container_name,
+        'psql', '-U', user, '-d', dbname,
+        '-v', 'ON_ERROR_STOP=1',  # Fail on the first error like -c does
+        '-f', '-'
+    ]
 
 def execute_sql(container_name, dbname, user, sql, description=None):
     """Execute SQL command and log the result."""
     if description:
         logging.info(f"Executing: {description}")
     
-    psql_command = f"docker exec -i {container_name} psql -U {user} -d {dbname} -c {shlex.quote(sql)}"
     try:
-        result = run_command(psql_command, shell=True)
+        # -c used to run a multi-statement string as one transaction; -1 keeps that so a failed
+        # statement doesn't leave half-created tables or graphs behind
+        result = run_command(psql_command(container_name, dbname, user) + ['-1'], input=sql)
         if description:
             logging.info(f"Success: {description}")
         return result
@@ -530,6 +864,76 @@ def execute_sql(container_name, dbname, user, sql, description=None):
         logging.error(f"Error output: {e.stderr}")
         raise
 
+class PsqlSession:
+    """A single psql process in the container that runs statements one at a time.
+
+    Each statement is followed by an echoed sentinel so its output can be read back
+    without reconnecting. Statements must be terminated with a semicolon.
+    """
+
+    def __init__(self, container_name: str, dbname: str = 'postgres', user: str = 'postgres'):
+        self.command = psql_command(container_name, dbname, user) + ['-q']
+        self._sentinels = itertools.count()
+        self.process = None
+
+    def __enter__(self):
+        # stderr goes to a file so notices can never fill a pipe while we wait on stdout
+        self._stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(
+            self.command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=self._stderr,
+            text=True
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        self.process.wait()
+        self.process.stdout.close()
+        self._stderr.close()
+
+    def execute(self, sql: str, description: str = None) -> str:
+        """Execute SQL in the session and log the result."""
+        if description:
+            logging.info(f"Executing: {description}")
+
+        try:
+            result = self._run(sql)
+        except subprocess.CalledProcessError as e:
+            if description:
+                logging.error(f"Failed: {description}")
+            logging.error(f"Error output: {e.stderr}")
+            raise
+
+        if description:
+            logging.info(f"Success: {description}")
+        return result
+
+    def _run(self, sql: str) -> str:
+        """Send SQL plus a sentinel to psql and read the output up to the sentinel."""
+        sentinel = f"__DONE_{next(self._sentinels)}__"
+        output = []
+        try:
+            self.process.stdin.write(f"{sql}\n\\echo {sentinel}\n")
+            self.process.stdin.flush()
+            for line in self.process.stdout:
+                if line.rstrip('\n') == sentinel:
+                    return ''.join(output).strip()
+                output.append(line)
+        except BrokenPipeError:
+            pass
+
+        # ON_ERROR_STOP makes psql exit before it reaches the sentinel
+        self.process.wait()
+        self._stderr.seek(0)
+        stderr = self._stderr.read().decode(errors='replace')
+        raise subprocess.CalledProcessError(self.process.returncode, self.command, ''.join(output), stderr)
+
 def create_extensions(container_name='postgres-extensions', dbname='postgres', user='postgres'):
     """Create all required extensions in the database."""
     logging.info("Creating extensions...")
@@ -541,12 +945,12 @@ def create_extensions(container_name='postgres-extensions', dbname='postgres', u
         ("LOAD 'vectors';", "Loading vectors"),
         ("CREATE EXTENSION IF NOT EXISTS age;", "Creating age extension"),
         ("LOAD 'age';", "Loading age"),
-        ("CREATE EXTENSION IF NOT EXISTS timescaledb;", "Creating timescaledb extension"),
-        ("SET search_path = ag_catalog, \"$user\", public, vectors;", "Setting search path")
+        ("CREATE EXTENSION IF NOT EXISTS timescaledb;", "Creating timescaledb extension")
     ]
     
-    for sql, description in steps:
-        execute_sql(container_name, dbname, user, sql, description)
+    with PsqlSession(container_name, dbname, user) as session:
+        for sql, description in steps:
+            session.execute(sql, description)
     
     logging.info("All extensions created successfully")
 
@@ -564,6 +968,9 @@ Examples:
   %(prog)s verify                   Verify extension installation
   %(prog)s test                     Run extension tests
   %(prog)s full-setup              Build image and start container
+  %(prog)s cleanup-builder         Remove the cached buildx builder
+  %(prog)s build --fresh-builder    Build with a newly created buildx builder
+  %(prog)s build --no-cache         Build without reusing any cached layers
         """
     )
     
@@ -572,7 +979,7 @@ Examples:
                       help='Generate Dockerfile from config without other actions')
     
     parser.add_argument('command', nargs='?',  # Make command optional
-                      choices=['start', 'remove', 'build', 'generate', 'verify', 'test', 'full-setup'],
+                      choices=['start', 'remove', 'build', 'generate', 'verify', 'test', 'full-setup', 'cleanup-builder'],
                       help='Command to execute')
     
     parser.add_argument('--container-name', default='postgres-extensions',
@@ -589,6 +996,14 @@ Examples:
     parser.add_argument('--platform',
                       help='Platform for Docker build (default: auto-detected)')
     
+    parser.add_argument('--no-cache', action='store_true',
+                      help='Rebuild every layer instead of reusing cached ones, e.g. to pick up new commits '
+                           'on a branch an extension follows')
+    
+    parser.add_argument('--fresh-builder', action='store_true',
+                      help='Recreate the buildx builder before building. The builder is kept between runs '
+                           'so its in-memory cache is reused; this costs a few seconds of startup and that cache')
+    
     parser.add_argument('--config', default='postgres-extensions.yaml',
                       help='Configuration file to use (default: postgres-extensions.yaml)')
     
@@ -598,20 +1013,26 @@ Examples:
 def main():
     # Load environment variables if .env file exists
     
-    if os.path.exists('.env'):
-        load_dotenv()
+    if os.path.isfile('.env'):
+        load_dotenv(override=False)
     else:
         logging.warning("No .env file found. Using default values.")
 
     parser = setup_argparse()
     args = parser.parse_args()
 
+    # Resolve container settings once: CLI arguments win over the environment, then defaults
+    settings = {
+        'port': args.port or os.getenv('POSTGRES_PORT', '5432'),
+        'volume_name': args.volume or os.getenv('POSTGRES_VOLUME', 'postgres-extensions-data'),
+        'password': os.getenv('POSTGRES_PASSWORD', 'postgres'),
+    }
+
     try:
         if args.generate or args.command == 'generate':
-            generator = DockerfileGenerator(args.config)
-            dockerfile_content = generator.generate_dockerfile()
-            with open('PostgresWithExtensions.dockerfile', 'w') as f:
-                f.write(dockerfile_content)
+            generator = DockerfileGenerator.from_file(args.config)
+            dockerfile_content = generator.dockerfile
+            write_dockerfile(dockerfile_content)
             logging.info("Dockerfile generated successfully")
             return
 
@@ -620,8 +1041,13 @@ def main():
             parser.error("Command is required unless --generate is specified")
 
         if args.command == 'build':
-            build_image(config_file=args.config, platform=args.platform)
+            build_image(config_file=args.config, platform=args.platform, fresh_builder=args.fresh_builder,
+                        no_cache=args.no_cache)
             
+        elif args.command == 'cleanup-builder':
+            logging.info("Removing builder...")
+            cleanup_buildx()
+
         elif args.command == 'remove':
             remove_container(args.container_name, args.remove_volume)
             
@@ -632,13 +1058,9 @@ def main():
             test_extensions(args.container_name)
             
         elif args.command == 'start':
-            port = args.port or os.getenv('POSTGRES_PORT', '5432')
-            volume = args.volume or os.getenv('POSTGRES_VOLUME', 'postgres-extensions-data')
-            
             remove_container(args.container_name)
-            if start_postgres_container(container_name=args.container_name, port=port, volume_name=volume):
-                if configure_extensions(args.container_name):
-                    time.sleep(2)
+            if start_postgres_container(container_name=args.container_name, **settings):
+                if configure_extensions(args.container_name, config_file=args.config):
                     create_extensions(args.container_name)
                     verify_extensions(args.container_name)
                     test_extensions(args.container_name)
@@ -649,20 +1071,23 @@ def main():
                 raise Exception("Failed to start PostgreSQL container")
                 
         elif args.command == 'full-setup':
-            # Build image first
-            build_image(config_file=args.config, platform=args.platform)
+            generator = DockerfileGenerator.from_file(args.config)
+
+            # Only remove the old container once the build succeeded, so a failed build leaves it running
+            build_image(config_file=args.config, platform=args.platform, generator=generator,
+                        fresh_builder=args.fresh_builder, no_cache=args.no_cache)
+            remove_container(args.container_name)
             
             # Then start container
-            port = args.port or os.getenv('POSTGRES_PORT', '5432')
-            volume = args.volume or os.getenv('POSTGRES_VOLUME', 'postgres-extensions-data')
-            
-            remove_container(args.container_name)
-            if start_postgres_container(container_name=args.container_name, port=port, volume_name=volume):
-                if configure_extensions(args.container_name):
-                    time.sleep(2)
+            if start_postgres_container(container_name=args.container_name, **settings):
+                if configure_extensions(args.container_name, config_file=args.config):
                     create_extensions(args.container_name)
-                    verify_extensions(args.container_name)
-                    test_extensions(args.container_name)
+                    # Verification and tests only issue queries, so they can share the server
+                    with ThreadPoolExecutor(max_workers=2) as executor:
+                        verification = executor.submit(verify_extensions, args.container_name)
+                        tests = executor.submit(test_extensions, args.container_name)
+                        verification.result()
+                        tests.result()
                     logging.info("Full setup completed successfully.")
                 else:
                     raise Exception("Failed to configure extensions")